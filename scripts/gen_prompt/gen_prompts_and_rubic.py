@@ -1,12 +1,20 @@
-import pandas as pd
 import os
 import json
+import orjson
+import asyncio
+import functools
+import math
 import time
 from datetime import datetime
 import random
 import logging
-from openai import OpenAI, RateLimitError, APIError, Timeout
+import openpyxl
+import aiofiles
+import httpx
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
+from tenacity import retry, wait_random_exponential, stop_after_attempt, retry_if_exception_type, before_sleep_log
 import  tools
+from schema import REQUIRED_TOP, REQUIRED_RUBIC
 
 # ===================== 配置区域 =====================
 # 建议通过环境变量设置 API Key，避免硬编码
@@ -15,13 +23,24 @@ QINIUYUN_API_KEY = os.getenv("QINIUYUN_API_KEY", "sk-c6bc1786fe3cf6ab55cdcc0e7c1
 CONTROL_NUM = 20  # 每次处理的最大数据量
 INPUT_DIR = "input"  # 输入目录（需与实际路径匹配）
 OUTPUT_DIR = "output"  # 输出目录
-API_RETRY_TIMES = 3  # API 调用失败重试次数
-API_DELAY = 2  # 每次API调用间隔（秒）
+API_RETRY_TIMES = 5  # API 调用最大尝试次数
+API_DELAY = 2  # 重试退避的最小间隔（秒）
+API_MAX_DELAY = 60  # 重试退避的最大间隔（秒）
+API_CONCURRENCY = 10  # 并发请求数上限
+# 账号速率限制（每分钟请求数/每分钟token数），用于主动限流
+OPENAI_MAX_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_MAX_REQUESTS_PER_MINUTE", "500"))
+OPENAI_MAX_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_MAX_TOKENS_PER_MINUTE", "1000000"))
 LANGUAGE = 'en'
 OPENAI_MODEL = "gpt-oss-120b"  # 使用的GPT模型（gpt-4/gpt-3.5-turbo）
 DATASET_FILENAME = "dataset_cn.xlsx" if LANGUAGE == 'cn' else "dataset_en.xlsx"
-MAX_TOKENS = 16384  # 适配模型的最大token限制，避免响应截断
+MAX_TOKENS_LIMIT = 8192  # 单次响应的输出token上限（模板要求输出低于7000 token）
+MAX_TOKENS = MAX_TOKENS_LIMIT  # 当前使用的输出token上限（试运行后可能被收紧）
+MIN_TUNED_MAX_TOKENS = 4096  # 收紧后的下限，避免少量样本把上限压得过低
+AUTO_TUNE_MAX_TOKENS = True  # 先试运行一批数据，按实际输出长度收紧 MAX_TOKENS
+PILOT_SIZE = 5  # 试运行条数（需小于 CONTROL_NUM，否则不会触发调整）
 ENABLED_SHUFFLE = True
+USE_BATCH_API = False  # 使用 Batch API 离线批量处理（费用减半，24h 内完成）
+BATCH_POLL_INTERVAL = 30  # Batch 任务状态轮询间隔（秒）
 gen_subject_white_list = [
     "自然科学",
     "nature science",
@@ -30,6 +49,11 @@ gen_subject_white_list = [
     "医疗与健康",
     "engineering",
 ]
+# Prompt 末尾的可变部分（模板本身保持不变，便于命中服务端前缀缓存）
+PROMPT_SUFFIX = {
+    'cn': "演示目标：\n学科：{subject}\n子学科：{sub_subject}\n实验名称：{requirement}",
+    'en': "Demonstration Objective:\nDiscipline: {subject}\nSubdiscipline: {sub_subject}\nExperimentName: {requirement}",
+}
 # ====================================================
 
 # 配置日志
@@ -46,42 +70,157 @@ logger = logging.getLogger(__name__)
 #     api_key=QINIUYUN_API_KEY
 # )
 
-client = OpenAI(
+# 所有请求共用一个连接池（HTTP/2 多路复用，重试时复用已建立的连接）
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=100),
+    timeout=httpx.Timeout(60.0, connect=10.0)
+)
+
+client = AsyncOpenAI(
     api_key=OPENAI_API_KEY,
-    base_url="https://api.apiyi.com/v1"
+    base_url="https://api.apiyi.com/v1",
+    http_client=http_client,
+    max_retries=0  # 重试统一由 chat_gpt 的 tenacity 处理（需经过限流与 retry-after）
 )
 
+
+class ResponseTruncatedError(Exception):
+    """GPT响应因达到 max_tokens 被截断（finish_reason == "length"）"""
+
+
+class RateLimiter:
+    """
+    基于令牌桶的主动限流：请求数和token数两个桶按分钟额度持续回填，
+    两个桶都有余量时才放行请求，避免触发 429
+    """
+
+    def __init__(self, max_requests_per_minute: int, max_tokens_per_minute: int):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.max_requests_per_minute,
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60
+        )
+        self.available_token_capacity = min(
+            self.max_tokens_per_minute,
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60
+        )
+        self.last_update_time = now
+
+    async def acquire(self, estimated_tokens: int):
+        """
+        等待直到两个桶都有足够余量，然后扣减额度
+        :param estimated_tokens: 本次请求预估消耗的token数
+        """
+        # 单次请求预估超过每分钟额度时按满额处理，避免永远等待
+        estimated_tokens = min(estimated_tokens, self.max_tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= estimated_tokens:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= estimated_tokens
+                    return
+                # 只等待回填所需的最短时间
+                request_wait = (1 - self.available_request_capacity) * 60 / self.max_requests_per_minute
+                token_wait = (estimated_tokens - self.available_token_capacity) * 60 / self.max_tokens_per_minute
+                await asyncio.sleep(max(request_wait, token_wait, 0))
+
+
+limiter = RateLimiter(OPENAI_MAX_REQUESTS_PER_MINUTE, OPENAI_MAX_TOKENS_PER_MINUTE)
+
+# 每次请求实际消耗的输出token数，用于调整 MAX_TOKENS
+output_token_usage = []
+
 # 确保输出目录存在
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-os.makedirs(os.path.join(OUTPUT_DIR, f"{LANGUAGE}/manual"), exist_ok=True)
-os.makedirs(os.path.join(OUTPUT_DIR, f"{LANGUAGE}/prompt"), exist_ok=True)
+os.makedirs(os.path.join(OUTPUT_DIR, f"{LANGUAGE}"), exist_ok=True)
 
 
-def chat_gpt(prompt: str) -> str:
+@retry(
+    wait=wait_random_exponential(min=API_DELAY, max=API_MAX_DELAY),
+    stop=stop_after_attempt(API_RETRY_TIMES),
+    # 流式读取过程中的网络错误不会被SDK转换，直接抛出 httpx.TransportError
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, InternalServerError, httpx.TransportError)),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True
+)
+async def chat_gpt(prompt: str, sem: asyncio.Semaphore, max_tokens: int = None) -> str:
     """
     调用 ChatGPT 接口，处理重试和速率限制
+    仅对限流/连接（含超时及流式读取中断）/服务端错误做指数退避重试，其余错误（如参数错误、鉴权失败）直接抛出
     :param prompt: 输入的提示词
+    :param sem: 控制并发请求数的信号量
+    :param max_tokens: 输出token上限，默认使用当前的 MAX_TOKENS
     :return: GPT 返回的响应文本（纯字符串）
+    :raises ResponseTruncatedError: 输出达到 max_tokens 被截断
     """
-    for retry in range(API_RETRY_TIMES):
-        try:
-            # 发送聊天请求
-            response = client.chat.completions.create(
+    max_tokens = max_tokens or MAX_TOKENS
+    # 按预估token数主动限流（输入约 4 字符/token，输出按上限预留）
+    await limiter.acquire(estimated_tokens=len(prompt) // 4 + max_tokens)
+    chunks = []
+    completion_tokens = None
+    finish_reason = None
+    try:
+        # 流式发送聊天请求，读到流结束（最后一个片段携带 usage）
+        async with sem:
+            stream = await client.chat.completions.create(
                 model="gpt-5-chat-latest",
                 messages=[
                     {"role": "user", "content": prompt},
                 ],
-                stream=False,
+                stream=True,
+                stream_options={"include_usage": True},
                 temperature=0,
+                response_format={"type": "json_object"},
                 timeout=30,
-                max_tokens=MAX_TOKENS
+                max_tokens=max_tokens
             )
-            return response.choices[0].message.content
-        except Exception as e:
-            logger.error(f"未知错误: {e}，重试次数：{retry + 1}/{API_RETRY_TIMES}")
-            time.sleep(API_DELAY * (retry + 1))
+            async for chunk in stream:
+                if chunk.usage:
+                    completion_tokens = chunk.usage.completion_tokens
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                chunks.append(chunk.choices[0].delta.content)
+    except RateLimitError as e:
+        # 优先遵循服务端返回的 retry-after，再进入退避重试
+        retry_after = e.response.headers.get("retry-after")
+        if retry_after:
+            try:
+                logger.warning(f"触发限流，按 retry-after 等待 {retry_after} 秒")
+                await asyncio.sleep(float(retry_after))
+            except ValueError:
+                pass
+        raise
 
-    raise Exception(f"API 调用失败，已重试 {API_RETRY_TIMES} 次")
+    # 只记录服务端返回的真实用量；片段数与token数不一定对应，缺失时跳过该样本
+    if completion_tokens is not None:
+        output_token_usage.append(completion_tokens)
+    if finish_reason == "length":
+        raise ResponseTruncatedError(f"GPT响应达到 max_tokens={max_tokens} 被截断")
+    return "".join(chunks)
+
+
+def measure_output_tokens() -> int:
+    """
+    根据已完成请求的输出token数，计算 P99 × 1.2 作为新的 MAX_TOKENS
+    :return: 建议的 MAX_TOKENS（介于 MIN_TUNED_MAX_TOKENS 与 MAX_TOKENS_LIMIT 之间），无统计数据时返回上限
+    """
+    if not output_token_usage:
+        return MAX_TOKENS_LIMIT
+    usage = sorted(output_token_usage)
+    p99 = usage[math.ceil(len(usage) * 0.99) - 1]
+    return max(MIN_TUNED_MAX_TOKENS, min(MAX_TOKENS_LIMIT, int(p99 * 1.2)))
 
 
 def get_prompt_template() -> str:
@@ -102,6 +241,8 @@ def get_prompt_template() -> str:
             with open(example_path, "r", encoding="utf-8") as f:
                 example_content = f.read()
             template = template.replace("{None}", example_content)
+        # 清理多余的换行和空格（只在读取时做一次，保证各行请求的Prompt前缀一致）
+        template = "\n".join([line.strip() for line in template.splitlines() if line.strip()])
         logger.info(f"成功读取 prompt 模板（{LANGUAGE}）")
         return template
     except FileNotFoundError:
@@ -110,10 +251,12 @@ def get_prompt_template() -> str:
         raise Exception(f"读取模板文件失败：{str(e)}")
 
 
+@functools.lru_cache(maxsize=4096)
 def get_complete_prompt(prompt_template: str, subject: str, sub_subject: str, requirement: str) -> str:
     """
-    拼接完整的 prompt：替换模板中的占位符
-    :param prompt_template: 基础模板
+    拼接完整的 prompt：在固定模板后追加学科/子学科/实验名称
+    （按参数缓存，相同数据重复出现或多次调用时直接复用）
+    :param prompt_template: 基础模板（已清理空白）
     :param subject: 学科
     :param sub_subject: 子学科
     :param requirement: 演示/知识点
@@ -122,20 +265,15 @@ def get_complete_prompt(prompt_template: str, subject: str, sub_subject: str, re
     if not all([subject, sub_subject, requirement]):
         raise ValueError("学科、子学科、实验名称均不能为空")
 
-    if LANGUAGE == 'cn':
-        complete_prompt = prompt_template.replace("{学科}", subject) \
-            .replace("{子学科}", sub_subject) \
-            .replace("{实验名称}", requirement)
-    elif LANGUAGE == 'en':
-        complete_prompt = prompt_template.replace("{Discipline}", subject) \
-            .replace("{Subdiscipline}", sub_subject) \
-            .replace("{ExperimentName}", requirement)
-    else:
+    if LANGUAGE not in PROMPT_SUFFIX:
         raise ValueError(f"不支持的语言类型：{LANGUAGE}")
 
-    # 清理多余的换行和空格
-    complete_prompt = "\n".join([line.strip() for line in complete_prompt.splitlines() if line.strip()])
-    return complete_prompt
+    suffix = PROMPT_SUFFIX[LANGUAGE].format_map({
+        "subject": subject.strip(),
+        "sub_subject": sub_subject.strip(),
+        "requirement": requirement.strip()
+    })
+    return prompt_template + "\n" + suffix
 
 
 def process_excel_file(file_path: str) -> list:
@@ -146,32 +284,44 @@ def process_excel_file(file_path: str) -> list:
     """
     requirement_list = []
     try:
-        excel_file = pd.ExcelFile(file_path)
-        for sheet_name in excel_file.sheet_names:
-            df = pd.read_excel(file_path, sheet_name=sheet_name)
-            # 列名大小写不敏感，兼容不同命名方式
-            df.columns = [col.strip().lower() for col in df.columns]
-            required_cols = ["sub-subject", "requirement_name"]
-            required_cols_lower = [col.lower() for col in required_cols]
-            if not all(col in df.columns for col in required_cols_lower):
-                logger.warning(f"Sheet {sheet_name} 缺少必要列（{required_cols}），跳过该sheet")
-                continue
-
-            # 遍历行，过滤空值和无效数据
-            for idx, row in df.iterrows():
-                sub_subject = str(row["sub-subject"]).strip() if pd.notna(row["sub-subject"]) else ""
-                requirement = str(row["requirement_name"]).strip() if pd.notna(row["requirement_name"]) else ""
-
-                if not (sub_subject and requirement) or sub_subject == "nan" or requirement == "nan":
-                    logger.warning(f"Sheet {sheet_name} 中发现空值/无效数据，跳过该行")
+        # 只读模式逐行流式读取，不把整个工作簿加载为DataFrame
+        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            for ws in wb.worksheets:
+                sheet_name = ws.title
+                header = next(ws.iter_rows(values_only=True), None)
+                if header is None:
+                    logger.warning(f"Sheet {sheet_name} 为空，跳过该sheet")
                     continue
-
-                requirement_list.append({
-                    "idx": f"{idx}-{sheet_name.strip()}-{sub_subject}-{requirement}",
-                    "subject": sheet_name.strip(),
-                    "sub_subject": sub_subject,
-                    "requirement": requirement
-                })
+                # 列名大小写不敏感，兼容不同命名方式
+                columns = [str(col).strip().lower() if col is not None else "" for col in header]
+                required_cols = ["sub-subject", "requirement_name"]
+                required_cols_lower = [col.lower() for col in required_cols]
+                if not all(col in columns for col in required_cols_lower):
+                    logger.warning(f"Sheet {sheet_name} 缺少必要列（{required_cols}），跳过该sheet")
+                    continue
+                sub_subject_col = columns.index("sub-subject")
+                requirement_col = columns.index("requirement_name")
+
+                # 遍历行，过滤空值和无效数据
+                for idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True)):
+                    sub_subject = row[sub_subject_col] if sub_subject_col < len(row) else None
+                    requirement = row[requirement_col] if requirement_col < len(row) else None
+                    sub_subject = str(sub_subject).strip() if sub_subject is not None else ""
+                    requirement = str(requirement).strip() if requirement is not None else ""
+
+                    if not (sub_subject and requirement) or sub_subject == "nan" or requirement == "nan":
+                        logger.warning(f"Sheet {sheet_name} 中发现空值/无效数据，跳过该行")
+                        continue
+
+                    requirement_list.append({
+                        "idx": f"{idx}-{sheet_name.strip()}-{sub_subject}-{requirement}",
+                        "subject": sheet_name.strip(),
+                        "sub_subject": sub_subject,
+                        "requirement": requirement
+                    })
+        finally:
+            wb.close()
 
         logger.info(f"成功处理Excel文件，共提取 {len(requirement_list)} 条有效数据")
         return requirement_list
@@ -182,6 +332,9 @@ def process_excel_file(file_path: str) -> list:
         raise Exception(f"处理Excel文件失败：{e}")
 
 
+_JSON_DECODER = json.JSONDecoder()
+
+
 def parse_gpt_response(response_text: str) -> dict:
     """
     解析GPT返回的内容，提取JSON格式数据（处理可能的格式问题）
@@ -189,37 +342,34 @@ def parse_gpt_response(response_text: str) -> dict:
     :return: 解析后的JSON字典
     """
     try:
-        # 提取JSON片段（处理GPT返回中可能的多余文本）
-        start_idx = response_text.find("{")
-        end_idx = response_text.rfind("}") + 1
-        if start_idx == -1 or end_idx == 0:
+        # 先修复多层转义（\\\\n → \\n），否则合法JSON中的文本会保留字面量 \\n
+        json_text = tools.normalize_escapes(response_text)
+        # 从第一个 { 开始原地解析，忽略JSON之后的多余文本（如 ``` 围栏、说明文字）
+        start_idx = json_text.find("{")
+        if start_idx == -1:
             raise ValueError("未找到有效的JSON格式内容")
 
-        json_str = response_text[start_idx:end_idx]
-        # 修复常见的JSON格式问题
-        json_str = json_str.replace("'", "\"") \
-            .replace("\\n", "") \
-            .replace("\\t", "") \
-            .replace("\1", "1") \
-            .replace("\2", "2") \
-            .replace("\3", "3") \
-            .replace("\4", "4") \
-            .replace("\5", "5") \
-            .replace("\6", "6") \
-            .replace("\7", "7") \
-            # print(json_str)
-        json_data = json.loads(json_str)
+        try:
+            json_data, _ = _JSON_DECODER.raw_decode(json_text, start_idx)
+        except json.JSONDecodeError:
+            # 格式有瑕疵时交给 tools 统一修复
+            end_idx = json_text.rfind("}") + 1
+            if end_idx <= start_idx:
+                raise ValueError("JSON内容不完整（缺少结尾的 }，响应可能被截断）")
+            json_data = tools.process_json_string(json_text[start_idx:end_idx])
 
         # 校验必要字段
-        required_fields = ["generation_prompt", "evaluation_rubic", "manual"]
-        for field in required_fields:
-            if field not in json_data:
-                raise ValueError(f"缺少必要字段：{field}")
-
-        required_rubic_fields = ["pc_rubic", "cmp_rubic", "slr_rubic", "clr_rubic", "ri_rubic"]
-        for field in required_rubic_fields:
-            if field not in json_data["evaluation_rubic"]:
-                raise ValueError(f"evaluation_rubic 缺少必要字段：{field}")
+        if not isinstance(json_data, dict):
+            raise ValueError("解析结果不是JSON对象")
+        missing = REQUIRED_TOP - json_data.keys()
+        if missing:
+            raise ValueError(f"缺少必要字段：{sorted(missing)}")
+
+        if not isinstance(json_data["evaluation_rubic"], dict):
+            raise ValueError("evaluation_rubic 不是JSON对象")
+        missing = REQUIRED_RUBIC - json_data["evaluation_rubic"].keys()
+        if missing:
+            raise ValueError(f"evaluation_rubic 缺少必要字段：{sorted(missing)}")
 
         logger.info("GPT响应JSON解析成功")
         return json_data
@@ -231,49 +381,248 @@ def parse_gpt_response(response_text: str) -> dict:
         raise Exception(f"解析GPT响应失败：{str(e)}")
 
 
+# Windows/UNIX非法文件名字符 → "_"
+_UNSAFE = str.maketrans({c: "_" for c in '/\\:*?"<>|'})
+
+
 # 生成安全的文件名（替换特殊字符+截断过长名称）
 def safe_filename(s: str) -> str:
-    if not s:
-        return "unknown"
-    # 替换Windows/UNIX非法字符
-    unsafe_chars = ['/', '\\', ':', '*', '?', '"', '<', '>', '|']
-    for char in unsafe_chars:
-        s = s.replace(char, "_")
-    # 截断过长文件名（避免系统限制）
-    return s[:50]  # 限制最大长度50字符
+    # 截断过长文件名（避免系统限制），限制最大长度50字符
+    return (s or "unknown").translate(_UNSAFE)[:50]
 
 
-def save_gpt_response(data: dict, json_data: dict):
+def get_prompt_json_path(data: dict) -> str:
     """
-    保存GPT响应结果：
-    1. markdown文件 → output/manual/
-    2. JSON文件 → output/prompt/
-    :param data: 原始数据（subject/sub_subject/requirement）
-    :param json_data: 解析后的GPT响应JSON
+    获取单条数据对应的输出JSON路径
+    :param data: 原始数据（需包含 idx）
+    :return: output/{LANGUAGE}/ 下的JSON文件路径
     """
-
     base_filename = safe_filename(data["idx"])
+    return os.path.join(OUTPUT_DIR, f"{LANGUAGE}", f"{base_filename}.json")
+
+
+def is_processed(data: dict) -> bool:
+    """
+    判断该条数据是否已有非空的输出文件（用于断点续跑，避免重复调用API）
+    :param data: 原始数据（需包含 idx）
+    """
+    json_path = get_prompt_json_path(data)
+    return os.path.exists(json_path) and os.path.getsize(json_path) > 0
 
-    # 保存manual文件
-    try:
-        markdown_content = json_data["manual"]
-        markdown_path = os.path.join(OUTPUT_DIR, f"{LANGUAGE}/manual", f"{base_filename}.md")
-        with open(markdown_path, "w", encoding="utf-8") as f:
-            f.write(markdown_content)
-        logger.info(f"manual文件已保存：{markdown_path}")
-    except Exception as e:
-        raise Exception(f"保存manual文件失败：{e}")
 
-    # 保存JSON文件
+async def save_prompt_json(data: dict, response_text: str):
+    """
+    修复并解析GPT返回的JSON文本，保存到 output/{LANGUAGE}/
+    :param data: 原始数据（subject/sub_subject/requirement）
+    :param response_text: GPT返回的文本
+    """
     try:
-        json_path = os.path.join(OUTPUT_DIR, f"{LANGUAGE}/prompt", f"{base_filename}.json")
-        with open(json_path, "w", encoding="utf-8") as f:
-            json.dump(json_data, f, ensure_ascii=False, indent=4)
+        json_path = get_prompt_json_path(data)
+        json_data = parse_gpt_response(response_text)
+        async with aiofiles.open(json_path, "wb") as f:
+            await f.write(orjson.dumps(json_data, option=orjson.OPT_INDENT_2))
         logger.info(f"prompt文件已保存：{json_path}")
     except Exception as e:
         raise Exception(f"保存prompt文件失败：{e}")
 
 
+async def process_row(idx: int, total: int, data: dict, prompt_template: str, sem: asyncio.Semaphore) -> bool:
+    """
+    处理单条数据：拼接Prompt → 调用GPT → 解析并保存结果
+    :param idx: 当前数据序号（用于日志）
+    :param total: 本次处理总数（用于日志）
+    :param data: 原始数据（subject/sub_subject/requirement）
+    :param prompt_template: 基础模板
+    :param sem: 控制并发请求数的信号量
+    :return: 成功处理返回 True，不在白名单中跳过返回 False
+    """
+    subject = data["subject"]
+    sub_subject = data["sub_subject"]
+    requirement = data["requirement"]
+
+    logger.info(f"\n处理第 {idx + 1}/{total} 条：")
+    logger.info(f"学科：{subject} | 子学科：{sub_subject} | 演示目标：{requirement}")
+    if subject not in gen_subject_white_list:
+        logger.info(f"\n不在学科白名单中，skip：")
+        return False
+    if is_processed(data):
+        logger.info(f"\n输出文件已存在，skip：{get_prompt_json_path(data)}")
+        return False
+
+    # 拼接完整Prompt
+    chat_prompt = get_complete_prompt(prompt_template, subject, sub_subject, requirement)
+
+    # 调用GPT接口（收紧后的上限导致截断时，按原始上限重试一次）
+    try:
+        response_text = await chat_gpt(chat_prompt, sem)
+    except ResponseTruncatedError as e:
+        if MAX_TOKENS >= MAX_TOKENS_LIMIT:
+            raise
+        logger.warning(f"{e}，按原始上限 {MAX_TOKENS_LIMIT} 重试")
+        response_text = await chat_gpt(chat_prompt, sem, max_tokens=MAX_TOKENS_LIMIT)
+    if not response_text:
+        raise ValueError("GPT返回空响应")
+
+    await save_prompt_json(data, response_text)
+    return True
+
+
+async def process_all(prompt_template: str, sampled: list) -> list:
+    """
+    并发处理所有待处理数据
+    :param prompt_template: 基础模板
+    :param sampled: 待处理的数据列表
+    :return: 每条数据的处理结果（True/False 或异常对象）
+    """
+    global MAX_TOKENS
+    sem = asyncio.Semaphore(API_CONCURRENCY)
+    tasks = [process_row(idx, len(sampled), data, prompt_template, sem) for idx, data in enumerate(sampled)]
+
+    # 先试运行一批数据，统计输出长度后收紧 MAX_TOKENS，降低后续请求的生成延迟
+    pilot_size = PILOT_SIZE if AUTO_TUNE_MAX_TOKENS and len(tasks) > PILOT_SIZE else 0
+    results = []
+    if pilot_size:
+        results += await asyncio.gather(*tasks[:pilot_size], return_exceptions=True)
+        if output_token_usage:
+            tuned_max_tokens = measure_output_tokens()
+            logger.info(f"试运行完成，MAX_TOKENS 调整为 {tuned_max_tokens}（原 {MAX_TOKENS}）")
+            MAX_TOKENS = tuned_max_tokens
+        else:
+            logger.warning("试运行未获取到 usage 数据，保持 MAX_TOKENS 不变")
+    results += await asyncio.gather(*tasks[pilot_size:], return_exceptions=True)
+    return results
+
+
+async def submit_batch(requirement_list: list, template: str) -> str:
+    """
+    将所有Prompt写入 batch.jsonl 并提交为 Batch 任务
+    :param requirement_list: 待处理的数据列表（idx 作为 custom_id，需唯一）
+    :param template: 基础模板
+    :return: Batch 任务ID
+    """
+    batch_path = os.path.join(OUTPUT_DIR, f"{LANGUAGE}", "batch.jsonl")
+    with open(batch_path, "wb") as f:
+        for data in requirement_list:
+            chat_prompt = get_complete_prompt(template, data["subject"], data["sub_subject"], data["requirement"])
+            line = {
+                "custom_id": data["idx"],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": "gpt-5-chat-latest",
+                    "messages": [
+                        {"role": "user", "content": chat_prompt},
+                    ],
+                    "temperature": 0,
+                    "response_format": {"type": "json_object"},
+                    "max_tokens": MAX_TOKENS
+                }
+            }
+            f.write(orjson.dumps(line) + b"\n")
+
+    with open(batch_path, "rb") as f:
+        batch_file = await client.files.create(file=f, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    logger.info(f"Batch任务已提交：{batch.id}（共 {len(requirement_list)} 条请求）")
+    return batch.id
+
+
+async def wait_for_batch(batch_id: str):
+    """
+    轮询 Batch 任务直到结束
+    :param batch_id: Batch 任务ID
+    :return: 已完成的 Batch 对象
+    """
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status == "completed":
+            logger.info(f"Batch任务已完成：{batch_id}")
+            return batch
+        if batch.status in ("failed", "expired", "cancelled"):
+            raise Exception(f"Batch任务未完成，状态：{batch.status}")
+        logger.info(f"Batch任务状态：{batch.status}，{BATCH_POLL_INTERVAL} 秒后重试")
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+
+async def process_batch(prompt_template: str, sampled: list) -> list:
+    """
+    通过 Batch API 处理所有待处理数据
+    :param prompt_template: 基础模板
+    :param sampled: 待处理的数据列表
+    :return: 每条数据的处理结果（True/False 或异常对象）
+    """
+    # custom_id 必须唯一，同一条数据只提交一次
+    pending = {
+        data["idx"]: data for data in sampled
+        if data["subject"] in gen_subject_white_list and not is_processed(data)
+    }
+    if not pending:
+        return [False] * len(sampled)
+
+    batch_id = await submit_batch(list(pending.values()), prompt_template)
+    batch = await wait_for_batch(batch_id)
+    if not batch.output_file_id and not batch.error_file_id:
+        raise Exception(f"Batch任务无输出文件：{batch_id}")
+
+    row_results = {}
+    # 失败的请求写入 error_file_id，而不是输出文件
+    if batch.error_file_id:
+        errors = await client.files.content(batch.error_file_id)
+        for line in errors.text.splitlines():
+            if not line.strip():
+                continue
+            item = orjson.loads(line)
+            error = item.get("error") or (item.get("response") or {}).get("body")
+            row_results[item["custom_id"]] = Exception(f"Batch请求失败：{error}")
+
+    output_lines = []
+    if batch.output_file_id:
+        output = await client.files.content(batch.output_file_id)
+        output_lines = output.text.splitlines()
+    for line in output_lines:
+        if not line.strip():
+            continue
+        item = orjson.loads(line)
+        custom_id = item["custom_id"]
+        try:
+            if item.get("error") or item["response"]["status_code"] != 200:
+                raise Exception(f"Batch请求失败：{item.get('error') or item['response']['body']}")
+            response_text = item["response"]["body"]["choices"][0]["message"]["content"]
+            if not response_text:
+                raise ValueError("GPT返回空响应")
+            await save_prompt_json(pending[custom_id], response_text)
+            row_results[custom_id] = True
+        except Exception as e:
+            row_results[custom_id] = e
+
+    results = []
+    for data in sampled:
+        if data["idx"] not in pending:
+            results.append(False)
+        else:
+            results.append(row_results.get(data["idx"], Exception("Batch输出中缺少该条结果")))
+    return results
+
+
+async def run(prompt_template: str, sampled: list) -> list:
+    """
+    异步主流程：并发处理或提交 Batch 任务，结束后关闭连接池
+    :param prompt_template: 基础模板
+    :param sampled: 待处理的数据列表
+    :return: 每条数据的处理结果（True/False 或异常对象）
+    """
+    try:
+        if USE_BATCH_API:
+            return await process_batch(prompt_template, sampled)
+        return await process_all(prompt_template, sampled)
+    finally:
+        await http_client.aclose()
+
+
 if __name__ == "__main__":
     try:
         logger.info("=" * 60)
@@ -285,65 +634,38 @@ if __name__ == "__main__":
         excel_path = os.path.join(INPUT_DIR, DATASET_FILENAME)
         requirement_list = process_excel_file(excel_path)
 
+        # 按 (学科, 子学科, 实验名称) 去重，相同内容只请求一次
+        seen = {}
+        for data in requirement_list:
+            seen.setdefault((data["subject"], data["sub_subject"], data["requirement"]), data)
+        total_count = len(requirement_list)
+        requirement_list = list(seen.values())
+        if total_count:
+            logger.info(f"去重后剩余 {len(requirement_list)}/{total_count} 条数据"
+                        f"（重复率 {1 - len(requirement_list) / total_count:.1%}）")
+
         # 2. 限制处理数量
         process_limit = min(len(requirement_list), CONTROL_NUM)
         logger.info(f"本次处理数量：{process_limit}（总计有效数据：{len(requirement_list)}）")
 
-        # 3. 遍历处理每条数据
-        processed_success = 0
-        processed_failed = 0
-
-        for idx in range(process_limit):
-            if ENABLED_SHUFFLE:
-                index = random.randint(0, len(requirement_list)-1)  # 可能重复抽中同一个，测试功能没影响
-            else:
-                index = idx
-
-            try:
-                data = requirement_list[index]
-                subject = data["subject"]
-                sub_subject = data["sub_subject"]
-                requirement = data["requirement"]
-
-                logger.info(f"\n处理第 {idx + 1}/{process_limit} 条：")
-                logger.info(f"学科：{subject} | 子学科：{sub_subject} | 演示目标：{requirement}")
-                if subject not in gen_subject_white_list:
-                    logger.info(f"\n不在学科白名单中，skip：")
-                    continue
+        # 随机抽样不放回，保证抽中的数据互不重复
+        if ENABLED_SHUFFLE:
+            indices = random.sample(range(len(requirement_list)), process_limit)
+        else:
+            indices = list(range(process_limit))
+        sampled = [requirement_list[index] for index in indices]
 
-                # 拼接完整Prompt
-                chat_prompt = get_complete_prompt(prompt_template, subject, sub_subject, requirement)
-
-                # 调用GPT接口
-                response_text = chat_gpt(chat_prompt)
-                if not response_text:
-                    raise ValueError("GPT返回空响应")
-
-                # # 解析GPT响应
-                # json_data = parse_gpt_response(response_text) # 容易遇到异常转义符，需要修
-                #
-                # # 保存结果
-                # save_gpt_response(data, json_data)
-
-                try:
-                    base_filename = safe_filename(data["idx"])
-                    json_path = os.path.join(OUTPUT_DIR, f"{LANGUAGE}", f"{base_filename}.json")
-                    with open(json_path, "w", encoding="utf-8") as f:
-                        json_str = tools.process_json_string(response_text)
-                        json.dump(json_str, f, ensure_ascii=False, indent=4)
-                    logger.info(f"prompt文件已保存：{json_path}")
-                except Exception as e:
-                    raise Exception(f"保存prompt文件失败：{e}")
-
-                # 计数+延迟（最后一条不延迟）
-                processed_success += 1
-                if idx < process_limit - 1:
-                    time.sleep(API_DELAY)
+        # 3. 并发处理每条数据（或提交 Batch 任务离线处理）
+        results = asyncio.run(run(prompt_template, sampled))
 
-            except Exception as e:
-                logger.error(f"处理第 {idx + 1} 条数据失败：{str(e)}", exc_info=True)
+        processed_success = 0
+        processed_failed = 0
+        for idx, result in enumerate(results):
+            if isinstance(result, Exception):
+                logger.error(f"处理第 {idx + 1} 条数据失败：{str(result)}", exc_info=result)
                 processed_failed += 1
-                continue
+            elif result:
+                processed_success += 1
 
         # 输出统计信息
         end_time = datetime.now()
@@ -359,4 +681,4 @@ if __name__ == "__main__":
 
     except Exception as e:
         logger.error(f"程序执行失败：{str(e)}", exc_info=True)
-        exit(1)
\ No newline at end of file
+        exit(1)
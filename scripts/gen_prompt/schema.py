@@ -0,0 +1,3 @@
+# GPT 返回JSON的必要字段（gen_prompts_and_rubic.py 与 tools.py 共用）
+REQUIRED_TOP = frozenset({"generation_prompt", "evaluation_rubic", "manual"})
+REQUIRED_RUBIC = frozenset({"pc_rubic", "cmp_rubic", "slr_rubic", "clr_rubic", "ri_rubic"})
@@ -1,6 +1,50 @@
 import json
 import re
 
+import orjson
+
+from schema import REQUIRED_TOP, REQUIRED_RUBIC
+
+# 全角标点 → 半角标点（单次 translate 完成全部替换）
+_PUNCT = str.maketrans({"：": ":", "，": ",", "”": '"', "“": '"', "；": ";", "。": ".", "（": "(", "）": ")"})
+# 预编译修复用的正则
+_RE_BAD_ESC = re.compile(r'\\(\d)')
+_RE_TRAILING_COMMA = re.compile(r',\s*([}\]])')
+_RE_BARE_KEY = re.compile(r'([{,]\s*)(\w+)(\s*:)')
+_RE_SQUOTE = re.compile(r"(?<!\\)\'")
+
+
+def normalize_escapes(json_str: str) -> str:
+    """
+    修复多层转义：\\\\n → \\n、\\\\t → \\t（GPT常返回的多余反斜杠，合法JSON中也会出现）
+    """
+    return json_str.replace("\\\\n", "\\n").replace("\\\\t", "\\t")
+
+
+def _validate(json_data) -> dict:
+    """
+    校验解析结果包含业务所需的关键字段
+
+    Raises:
+        ValueError: 关键字段缺失
+    """
+    if not isinstance(json_data, dict):
+        raise ValueError(f"解析结果不是JSON对象：{type(json_data).__name__}")
+
+    missing_fields = REQUIRED_TOP - json_data.keys()
+    if missing_fields:
+        raise ValueError(f"解析后的JSON缺失关键字段：{sorted(missing_fields)}")
+
+    # 额外验证evaluation_rubic的子字段（可选，根据你的业务需求调整）
+    rubic_data = json_data["evaluation_rubic"]
+    if not isinstance(rubic_data, dict):
+        raise ValueError("evaluation_rubic 不是JSON对象")
+    missing_rubic = REQUIRED_RUBIC - rubic_data.keys()
+    if missing_rubic:
+        raise ValueError(f"evaluation_rubic缺失子字段：{sorted(missing_rubic)}")
+
+    return json_data
+
 
 def process_json_string(raw_json_str: str) -> dict:
     """
@@ -29,23 +73,27 @@ def process_json_string(raw_json_str: str) -> dict:
         raise ValueError("输入的JSON字符串为空")
 
     # 步骤2：修复转义符问题（核心）
-    fix_str = cleaned_str
     # 2.1 修复多层转义（\\\\n → \\n，GPT常返回的多余反斜杠）
-    fix_str = fix_str.replace("\\\\n", "\\n").replace("\\\\t", "\\t")
+    fix_str = normalize_escapes(cleaned_str)
+
+    # 快速路径：已是合法JSON时直接返回，无需其余修复
+    try:
+        return _validate(orjson.loads(fix_str))
+    except json.JSONDecodeError:
+        pass
+
     # 2.2 修复非法转义序列（\1、\2、\3 → \n1、\n2、\n3，常见笔误）
-    fix_str = re.sub(r'\\(\d)', r'\\n\1', fix_str)
+    fix_str = _RE_BAD_ESC.sub(r'\\n\1', fix_str)
     # 2.3 修复全角标点（替换为半角，避免解析错误）
-    fix_str = fix_str.replace("：", ":").replace("，", ",").replace("”", "\"").replace("“", "\"")
-    fix_str = fix_str.replace("；", ";").replace("。", ".").replace("（", "(").replace("）", ")")
+    fix_str = fix_str.translate(_PUNCT)
 
     # 步骤3：修复JSON格式瑕疵
     # 3.1 移除最后一个元素后的多余逗号（比如 "key":"value", } → "key":"value" }）
-    fix_str = re.sub(r',\s*}', '}', fix_str)
-    fix_str = re.sub(r',\s*]', ']', fix_str)
+    fix_str = _RE_TRAILING_COMMA.sub(r'\1', fix_str)
     # 3.2 确保属性名被双引号包裹（防止GPT返回无引号的键名）
-    fix_str = re.sub(r'([{,]\s*)(\w+)(\s*:)', r'\1"\2"\3', fix_str)
+    fix_str = _RE_BARE_KEY.sub(r'\1"\2"\3', fix_str)
     # 3.3 修复单引号（如果有）→ 双引号（排除已转义的单引号）
-    fix_str = re.sub(r'(?<!\\)\'', '"', fix_str)
+    fix_str = _RE_SQUOTE.sub('"', fix_str)
 
     # 步骤4：解析JSON并捕获详细错误
     try:
@@ -61,19 +109,7 @@ def process_json_string(raw_json_str: str) -> dict:
         raise json.JSONDecodeError(error_msg, e.doc, e.pos) from e
 
     # 步骤5：验证关键字段（确保解析结果符合业务预期）
-    required_fields = ["generation_prompt", "evaluation_rubic", "manual"]
-    missing_fields = [f for f in required_fields if f not in json_data]
-    if missing_fields:
-        raise ValueError(f"解析后的JSON缺失关键字段：{missing_fields}")
-
-    # 额外验证evaluation_rubic的子字段（可选，根据你的业务需求调整）
-    rubic_fields = ["pc_rubic", "cmp_rubic", "slr_rubic", "clr_rubic", "ri_rubic"]
-    rubic_data = json_data.get("evaluation_rubic", {})
-    missing_rubic = [f for f in rubic_fields if f not in rubic_data]
-    if missing_rubic:
-        raise ValueError(f"evaluation_rubic缺失子字段：{missing_rubic}")
-
-    return json_data
+    return _validate(json_data)
 
 
 # ===================== 测试示例（使用你提供的JSON字符串） =====================